@@ -2,17 +2,33 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import copy
 import datetime
+import functools
 import gzip
+import heapq
 import json
 import logging
+import math
+import multiprocessing
 import os
 import re
-from collections import namedtuple
-from statistics import median
+from array import array
+from collections import Counter, defaultdict, namedtuple
+from itertools import islice
 from string import Template
-from typing import Callable, Dict, Iterator, Optional, Tuple
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    # google-re2 is optional, it gives linear time matching for log format regexp
+    import re2
+except ImportError:
+    re2 = None
+
+try:
+    # python-isal is optional, it decompresses gzip log files faster than gzip module
+    from isal import igzip
+except ImportError:
+    igzip = None
 
 DEFAULT_CONFIG = {
     "REPORT_SIZE": 10,
@@ -20,13 +36,14 @@ DEFAULT_CONFIG = {
     "LOG_DIR": "./logs",
     "LOG_FILE": None,
     "ERRORS_LIMIT": 0.64,
+    "WORKERS": 1,
 }
 
 DEFAULT_CONFIG_PATH = "./config.json"
 
 FILE_NAME_REGEXP = re.compile(r"^nginx-access-ui\.log-(?P<date>\d{8})(\.gz)?$")
 
-NGINX_LOG_FORMAT_REGEXP = re.compile(
+NGINX_LOG_FORMAT_REGEXP = (re2 or re).compile(
     r"(?P<ipaddress>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\s+(?P<remote_user>.*?)\s+"
     r"(?P<http_x_real_ip>.*?)\s+\[(?P<time_local>.*?)\]\s+\"(?P<request_method>.*?)\s+"
     r"(?P<path>.*?)(?P<request_version>\s+HTTP/.*)?\"\s+(?P<status>.*?)\s+"
@@ -35,6 +52,20 @@ NGINX_LOG_FORMAT_REGEXP = re.compile(
     r"\"(?P<http_X_RB_USER>.*)\"\s+(?P<request_time>\d+\.?\d*)"
 )
 
+# number of quote characters in log line: request, http_referer, user_agent,
+# http_x_forwarded_for, http_X_REQUEST_ID and http_X_RB_USER fields are quoted
+LOG_FORMAT_QUOTES_COUNT = 12
+
+# number of log lines which are read and parsed at once, also a unit of work for worker processes
+PARSE_CHUNK_SIZE = 100_000
+
+# median of buckets bigger than this size is calculated with histogram of values
+MEDIAN_HISTOGRAM_THRESHOLD = 10_000
+
+# result of process_line for broken lines, they are collected under None url
+# and removed from statistics after parsing
+PARSE_ERROR = (None, 0.0)
+
 CUR_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -80,75 +111,217 @@ def find_last_log_file(dir_path: str) -> Optional[namedtuple]:
     )
 
     # try to find last log file
-    for file_name in os.listdir(dir_path):
-        match = re.match(FILE_NAME_REGEXP, file_name)
-
-        if match:
-            log_date = match.groupdict()["date"]
-            try:
-                log_date = datetime.datetime.strptime(log_date, "%Y%m%d").date()
-            except ValueError:
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            file_name = entry.name
+
+            # cheap prefix check before regexp matching
+            if not file_name.startswith("nginx-access-ui.log-"):
                 continue
 
-            if not last_log_info or log_date > last_log_info.date:
-                last_log_info = LogInfo(os.path.join(dir_path, file_name), log_date)
+            match = FILE_NAME_REGEXP.match(file_name)
+            if match:
+                log_date = match.group("date")
+                try:
+                    log_date = datetime.date(
+                        int(log_date[:4]), int(log_date[4:6]), int(log_date[6:])
+                    )
+                except ValueError:
+                    continue
+
+                if not last_log_info or log_date > last_log_info.date:
+                    last_log_info = LogInfo(entry.path, log_date)
 
     return last_log_info
 
 
-def process_line(line: str) -> Optional[Tuple[str, float]]:
+def process_line(line: str) -> Tuple[Optional[str], float]:
     """
     Process one line of log file.
 
     :param line: log line
-    :return: tuple with route and request_time if line match to regexp
+    :return: tuple with route and request_time, PARSE_ERROR if line doesn't match to log format
     """
 
+    # fast path specialized for nginx log format: path is the second token of
+    # the first quoted field and request_time is the field after the last quote.
+    # It is used only if line has all quoted fields of the format and request_time
+    # is digits with at most one dot like \d+\.?\d* in regexp, other lines go to regexp
+    fields = line.split('"')
+    if len(fields) == LOG_FORMAT_QUOTES_COUNT + 1 and fields[-1][:1].isspace():
+        request = fields[1].split(None, 2)
+        request_time = fields[-1].strip()
+        digits = request_time.replace(".", "", 1)
+        if len(request) > 1 and digits.isdecimal() and request_time[0] != ".":
+            return request[1], float(request_time)
+
+    # fallback to full log format regexp for unusual lines
     result = NGINX_LOG_FORMAT_REGEXP.match(line)
     if result:
         url, request_time = result.group("path"), float(result.group("request_time"))
         return url, request_time
 
+    return PARSE_ERROR
+
+
+def calculate_median(values: Sequence[float]) -> float:
+    """
+    Calculate median of values.
+
+    :param values: not empty sequence of numbers
+    :return: median of values
+    """
 
-def parse_log(file_path: str) -> Iterator[Optional[Tuple[str, float]]]:
+    n = len(values)
+    if n == 1:
+        return values[0]
+
+    if n > MEDIAN_HISTOGRAM_THRESHOLD:
+        # request_time has millisecond resolution, so big buckets contain a lot of
+        # equal values and counting them is cheaper than sorting the whole bucket
+        histogram = Counter(values)
+        left, right = (n - 1) // 2, n // 2
+        seen, low = 0, None
+        for value in sorted(histogram):
+            seen += histogram[value]
+            if low is None and seen > left:
+                low = value
+            if seen > right:
+                return (low + value) / 2
+
+    values = sorted(values)
+    middle = n // 2
+    if n % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def read_log(file_path: str) -> Iterator[List[str]]:
     """
-    Return one line of log at time.
+    Return chunk of log lines at time.
 
     :param file_path: path to file with logs
     """
 
-    file_open = gzip.open if file_path.endswith(".gz") else open
+    file_open = (igzip or gzip).open if file_path.endswith(".gz") else open
     with file_open(file_path, "rt") as f:
-        for line in f:
-            yield process_line(line)
+        while True:
+            lines = list(islice(f, PARSE_CHUNK_SIZE))
+            if not lines:
+                break
+            yield lines
+
+
+def create_url_statistics() -> list:
+    """
+    Create empty [count, time_sum, time_max, request_times] statistics of url.
+
+    Module level function is used instead of lambda as defaultdict factory
+    because statistics are pickled when returned from worker processes.
+    """
+
+    return [0, 0.0, -math.inf, array("d")]
+
+
+def update_statistics(statistics: Dict, lines: List[str]) -> None:
+    """
+    Parse chunk of log lines and update statistics of each url with it.
+
+    :param statistics: defaultdict with [count, time_sum, time_max, request_times] by each url
+    :param lines: chunk of log lines
+    """
+
+    # parse chunk with map to move per line loop from python bytecode to C,
+    # broken lines are counted under None url so the loop has no extra branch
+    for url, request_time in map(process_line, lines):
+        # keep count, sum and max of request_time for each url in streaming way,
+        # request times are kept as raw doubles only to calculate exact median
+        url_statistics = statistics[url]
+        url_statistics[0] += 1
+        url_statistics[1] += request_time
+        if request_time > url_statistics[2]:
+            url_statistics[2] = request_time
+        url_statistics[3].append(request_time)
+
+
+def aggregate_lines(lines: List[str]) -> Dict:
+    """
+    Calculate statistics of chunk of log lines, used in worker processes.
+
+    :param lines: chunk of log lines
+    :return: statistics by each url
+    """
+
+    statistics = defaultdict(create_url_statistics)
+    update_statistics(statistics, lines)
+    return statistics
+
+
+def merge_statistics(statistics: Dict, other: Dict) -> None:
+    """
+    Merge statistics of each url from other into statistics.
+
+    :param statistics: dictionary with [count, time_sum, time_max, request_times] by each url
+    :param other: dictionary of the same format which is merged into statistics
+    """
+
+    for url, other_statistics in other.items():
+        url_statistics = statistics.get(url)
+        if url_statistics is None:
+            statistics[url] = other_statistics
+            continue
+        url_statistics[0] += other_statistics[0]
+        url_statistics[1] += other_statistics[1]
+        if other_statistics[2] > url_statistics[2]:
+            url_statistics[2] = other_statistics[2]
+        url_statistics[3].extend(other_statistics[3])
 
 
 def calculate_statistics(
-    file_path: str, log_parser: Callable, errors_limit: float = None
+    file_path: str,
+    log_reader: Callable,
+    errors_limit: float = None,
+    workers: int = 1,
+    report_size: int = None,
 ) -> Dict:
     """
     Calculate statistics using data from file.
 
     :param file_path: path to file with logs
-    :param log_parser: logs file parser
+    :param log_reader: logs file reader which returns chunks of lines
     :param errors_limit: error percent that critical to statistics
-    :return: dictionary with statistics by each unique url
+    :param workers: number of processes which parse log lines
+    :param report_size: number of urls with the biggest time_sum to calculate statistics for, all urls if None
+    :return: dictionary with statistics by each unique url, ordered by time_sum if report_size is set
     """
 
-    total = processed = processed_request_time = 0
-    statistics = {}
-
-    for parsed_line in log_parser(file_path):
-        total += 1
-        if parsed_line:
-            processed += 1
-            url, request_time = parsed_line
-            statistics.setdefault(url, []).append(request_time)
-            processed_request_time += request_time
+    statistics = defaultdict(create_url_statistics)
+
+    if workers > 1:
+        # parse chunks in worker processes and merge their statistics
+        with multiprocessing.Pool(workers) as pool:
+            for chunk_statistics in pool.imap_unordered(
+                aggregate_lines, log_reader(file_path)
+            ):
+                merge_statistics(statistics, chunk_statistics)
+    else:
+        for lines in log_reader(file_path):
+            update_statistics(statistics, lines)
+
+    # broken lines were collected under None url
+    error_statistics = statistics.pop(None, None)
+    errors = error_statistics[0] if error_statistics else 0
+
+    # totals are collected from url statistics instead of per line counters
+    processed = processed_request_time = 0
+    for count, time_sum, _, _ in statistics.values():
+        processed += count
+        processed_request_time += time_sum
+    total = processed + errors
 
     if errors_limit is not None and total > 0:
-        cur_errors_limit = (total - processed) / total
-        if cur_errors_limit:
+        cur_errors_limit = errors / total
+        if cur_errors_limit > errors_limit:
             raise ErrorsLimitExceedError(
                 f"Errors limit = {errors_limit} was exceed, current errors limit={cur_errors_limit}"
             )
@@ -156,16 +329,21 @@ def calculate_statistics(
     all_count = processed
     all_time_sum = processed_request_time
 
+    # count, time_sum and time_max are already known, median is the only statistic
+    # which walks request times, so calculate it only for urls which get into report
+    url_statistics = statistics.items()
+    if report_size is not None:
+        url_statistics = heapq.nlargest(
+            report_size, url_statistics, key=lambda x: x[1][1]
+        )
+
     # calculate enriched_ statistics for html report
     enriched_statistics = {}
-    for url, data in statistics.items():
-        count = len(data)
+    for url, (count, time_sum, time_max, request_times) in url_statistics:
         count_perc = count / all_count
-        time_sum = sum(data)
         time_perc = time_sum / all_time_sum
         time_avg = time_sum / count
-        time_max = max(data)
-        time_med = median(data)
+        time_med = calculate_median(request_times)
 
         enriched_statistics[url] = {
             "url": url,
@@ -181,6 +359,20 @@ def calculate_statistics(
     return enriched_statistics
 
 
+@functools.lru_cache(maxsize=4)
+def load_template(template_file_path: str) -> Template:
+    """
+    Read report template, result is cached so template is read from disk
+    only once per process.
+
+    :param template_file_path: path to template
+    :return: report template
+    """
+
+    with open(template_file_path) as f:
+        return Template(f.read())
+
+
 def render_template(
     template_file_path: str, report_file_path: str, statistics: list[dict]
 ) -> None:
@@ -192,11 +384,10 @@ def render_template(
     :param statistics: list of dict with statistics
     """
 
-    # open report template file and replace $table_json to our data
+    # load report template and replace $table_json to our data
     try:
-        with open(template_file_path) as f:
-            s = Template(f.read())
-            s = s.safe_substitute(table_json=json.dumps(statistics))
+        s = load_template(template_file_path)
+        s = s.safe_substitute(table_json=json.dumps(statistics))
     except FileNotFoundError:
         logging.error(f"Template file {template_file_path} was not founded")
         return
@@ -238,11 +429,13 @@ def main(config: dict) -> None:
         return
 
     statistics = calculate_statistics(
-        last_log_info.file_path, parse_log, config["ERRORS_LIMIT"]
+        last_log_info.file_path,
+        read_log,
+        config["ERRORS_LIMIT"],
+        config.get("WORKERS", DEFAULT_CONFIG["WORKERS"]),
+        config["REPORT_SIZE"],
     )
-    top_statistics = sorted(
-        statistics.values(), key=lambda x: x["time_sum"], reverse=True
-    )[: config["REPORT_SIZE"]]
+    top_statistics = list(statistics.values())
 
     render_template(template_file_path, report_file_path, top_statistics)
 
@@ -253,9 +446,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--config", help="path to config file", default=DEFAULT_CONFIG_PATH
     )
+    parser.add_argument(
+        "--workers", help="number of processes which parse log file", type=int
+    )
     args = parser.parse_args()
     config_filepath = args.config
-    config = copy.deepcopy(DEFAULT_CONFIG)
+    config = DEFAULT_CONFIG.copy()
 
     # read external config file
     try:
@@ -266,6 +462,10 @@ if __name__ == "__main__":
     except FileNotFoundError:
         logging.error(f"Config file {config_filepath} was not founded")
 
+    # command line workers number has priority over config file
+    if args.workers is not None:
+        config["WORKERS"] = args.workers
+
     # setup logging configs
     setup_logging(config["LOG_FILE"])
 
@@ -3,9 +3,12 @@ import gzip
 import json
 import logging
 import os
+import random
 import shutil
 import unittest
+from statistics import median
 from typing import Optional
+from unittest import mock
 
 import log_analyzer as log_analyzer
 
@@ -158,6 +161,30 @@ def set_up_test_files() -> list:
     return [(k, v) for k, v in cases_dict.items()]
 
 
+def run_and_read_report(config: dict, report_file_name: str) -> list:
+    """
+    Run log analyzer with config and read statistics from created report
+
+    :param config: log analyzer configs
+    :param report_file_name: name of report file in report directory
+    :return: list of dict with statistics from report
+    """
+
+    # close previous log handler
+    log = logging.getLogger()
+    for hdlr in log.handlers:
+        hdlr.close()
+        log.removeHandler(hdlr)
+
+    log_analyzer.setup_logging(config["LOG_FILE"])
+    log_analyzer.main(config)
+
+    # read result from report file
+    with open(os.path.join(config["REPORT_DIR"], report_file_name)) as f:
+        data = f.read()
+    return json.loads(data.split("= ")[1][:-1])
+
+
 class TestAnalyzer(unittest.TestCase):
     def setUp(self):
         self.cases = set_up_test_files()
@@ -223,6 +250,17 @@ class TestAnalyzer(unittest.TestCase):
             data, TEST_ANSWER_1, msg="Report file contain not correct data"
         )
 
+    def test_case_1_report_file_contain_correct_data_with_workers(self):
+        case_name, config = self.cases[0]
+        config["WORKERS"] = 2
+
+        data = run_and_read_report(config, "report-2017.06.29.html")
+
+        # check that report result is correct
+        self.assertCountEqual(
+            data, TEST_ANSWER_1, msg="Report file contain not correct data"
+        )
+
     def test_case_2_rise_not_founded_log_files(self):
         case_name, config = self.cases[1]
 
@@ -276,9 +314,117 @@ class TestAnalyzer(unittest.TestCase):
 
         self.assertRaises(Exception, log_analyzer.main, config)
 
+    def test_case_4_rise_errors_limit_exceed_with_workers(self):
+        case_name, config = self.cases[3]
+        config["WORKERS"] = 2
+
+        # close previous log handler
+        log = logging.getLogger()
+        for hdlr in log.handlers:
+            hdlr.close()
+            log.removeHandler(hdlr)
+
+        # broken line is counted only if it is merged from worker results
+        with mock.patch.object(log_analyzer, "PARSE_CHUNK_SIZE", 1):
+            self.assertRaises(
+                log_analyzer.ErrorsLimitExceedError, log_analyzer.main, config
+            )
+
+    def test_case_4_errors_under_limit(self):
+        case_name, config = self.cases[3]
+        config["ERRORS_LIMIT"] = 0.5
+
+        data = run_and_read_report(config, "report-2017.06.28.html")
+
+        # check that broken line is not counted under any url
+        self.assertCountEqual(
+            data, TEST_ANSWER_1, msg="Report file contain not correct data"
+        )
+
+    def test_case_4_errors_under_limit_with_workers(self):
+        case_name, config = self.cases[3]
+        config["ERRORS_LIMIT"] = 0.5
+        config["WORKERS"] = 2
+
+        # parse every line in separate chunk, so statistics of urls and
+        # broken lines from different worker results are merged
+        with mock.patch.object(log_analyzer, "PARSE_CHUNK_SIZE", 1):
+            data = run_and_read_report(config, "report-2017.06.28.html")
+
+        # check that broken line is not counted under any url
+        self.assertCountEqual(
+            data, TEST_ANSWER_1, msg="Report file contain not correct data"
+        )
+
     def tearDown(self):
         shutil.rmtree("./test_environments")
 
 
+class TestProcessLine(unittest.TestCase):
+    def test_process_line_extract_url_and_request_time(self):
+        for line, answer in zip(
+            TEST_LOG_1.splitlines(), [("/api1", 1.0), ("/api1", 1.4), ("/api2", 2.0)]
+        ):
+            self.assertEqual(log_analyzer.process_line(line), answer)
+
+    def test_process_line_real_nginx_line(self):
+        line = (
+            '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" '
+            '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" '
+            '"dc7161be3" 0.390\n'
+        )
+        self.assertEqual(
+            log_analyzer.process_line(line), ("/api/v2/banner/25019354", 0.39)
+        )
+
+    def test_process_line_return_parse_error_for_broken_line(self):
+        self.assertEqual(
+            log_analyzer.process_line(TEST_LOG_2.splitlines()[-1]),
+            log_analyzer.PARSE_ERROR,
+        )
+        self.assertEqual(
+            log_analyzer.process_line("broken line"), log_analyzer.PARSE_ERROR
+        )
+
+    def test_process_line_return_parse_error_for_truncated_line(self):
+        line = '0.0.0.0 -  - [] "GET /api1 HTTP/1.1" 200 927\n'
+        self.assertEqual(log_analyzer.process_line(line), log_analyzer.PARSE_ERROR)
+
+    def test_process_line_return_parse_error_for_not_numeric_request_time(self):
+        for request_time in ("nan", "inf", "-1"):
+            line = TEST_LOG_1.splitlines()[0][:-1] + request_time
+            self.assertEqual(log_analyzer.process_line(line), log_analyzer.PARSE_ERROR)
+
+    def test_process_line_path_after_several_spaces(self):
+        line = '0.0.0.0 -  - [] "GET  /dbl HTTP/1.1" 200 927 "-" "-" "-" "-" "-" 1\n'
+        self.assertEqual(log_analyzer.process_line(line), ("/dbl", 1.0))
+
+    def test_process_line_not_decimal_request_time(self):
+        # like log format regexp only leading digits are taken as request_time
+        for request_time in ("1e3", "1_0", "1e999"):
+            line = TEST_LOG_1.splitlines()[0][:-1] + request_time
+            self.assertEqual(log_analyzer.process_line(line), ("/api1", 1.0))
+
+    def test_process_line_return_parse_error_for_garbage_line(self):
+        self.assertEqual(
+            log_analyzer.process_line('garbage "x y" 3'), log_analyzer.PARSE_ERROR
+        )
+
+
+class TestCalculateMedian(unittest.TestCase):
+    def test_calculate_median_small_bucket(self):
+        self.assertEqual(log_analyzer.calculate_median([2.0]), 2.0)
+        self.assertEqual(log_analyzer.calculate_median([3.0, 1.0, 2.0]), 2.0)
+        self.assertEqual(log_analyzer.calculate_median([1.0, 1.4]), 1.2)
+
+    def test_calculate_median_big_bucket(self):
+        random.seed(0)
+        for size in (20_000, 20_001):
+            values = [round(random.expovariate(3), 3) for _ in range(size)]
+            self.assertEqual(
+                log_analyzer.calculate_median(list(values)), median(values)
+            )
+
+
 if __name__ == "__main__":
     unittest.main()